@@ -1,94 +1,247 @@
 import os
-import requests
+import asyncio
+import logging
+import queue
+import random
+import time
+import aiohttp
+import orjson
+from logging.handlers import QueueHandler, QueueListener
 from typing import Final
-from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+from cachetools import TLRUCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler, ContextTypes
+    Application, CommandHandler, CallbackQueryHandler, ContextTypes,
+    PicklePersistence, PersistenceInput, AIORateLimiter
 )
 
 BOT_USERNAME: Final = "CryptoPriceBot"
 BOT_TOKEN: Final = "Your Bot Token"
 COINGECKO_API_URL: Final = "https://api.coingecko.com/api/v3"
+PERSISTENCE_FILE: Final = "bot_state.pkl"
 CACHE_TTL = 300
+CACHE_TTLS: Final = {  # per-endpoint overrides of CACHE_TTL
+    "coins/markets": 120,
+}
+NEGATIVE_CACHE_TTL = 60
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=5)
+MAX_CONCURRENT_REQUESTS = 5
+MAX_REQUESTS_PER_MINUTE = 25
+RETRY_AFTER_MAX = 60
+MARKETS_REFRESH_INTERVAL = 60
+TOP_MARKETS_PARAMS: Final = {"vs_currency": "usd", "order": "market_cap_desc", "per_page": 10}
 
-cache = TTLCache(maxsize=100, ttl=CACHE_TTL)
-user_favorites = {}
+HELP_TEXT: Final = (
+    "*Welcome to Crypto Price Bot!*\n"
+    "Commands:\n"
+    "/start - Main menu\n"
+    "/help - Help message\n"
+    "/favorites - Show favorite cryptos"
+)
+MAIN_MENU_MARKUP: Final = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Top Cryptocurrencies", callback_data="top100")],
+    [InlineKeyboardButton("Favorites", callback_data="favorites")],
+])
+
+logger = logging.getLogger(__name__)
+
+def cache_ttu(key, value, now):
+    """Expiry time for a cache entry: per-endpoint TTL, or a short one for failures."""
+    if value is None:
+        return now + NEGATIVE_CACHE_TTL
+    return now + CACHE_TTLS.get(key[0], CACHE_TTL)
+
+cache = TLRUCache(maxsize=100, ttu=cache_ttu)
+api_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+api_limiter = AsyncLimiter(MAX_REQUESTS_PER_MINUTE, 60)
+inflight = {}  # cache_key -> asyncio.Future of the pending response
+rate_limited_until = 0.0  # time.monotonic() deadline from CoinGecko's last Retry-After
+
+def retry_after(headers) -> float:
+    """Seconds CoinGecko asked us to wait after a 429, capped at RETRY_AFTER_MAX."""
+    try:
+        return min(float(headers.get("Retry-After", RETRY_AFTER_MAX)), RETRY_AFTER_MAX)
+    except ValueError:
+        return RETRY_AFTER_MAX
+
+def rate_limited() -> bool:
+    return time.monotonic() < rate_limited_until
 
-def api_request(endpoint: str, params: dict = None):
-    """Fetch data from API with caching."""
-    cache_key = f"{endpoint}:{params}"
-    if cache_key in cache:
+async def fetch_json(session: aiohttp.ClientSession, endpoint: str, params: dict = None):
+    """Fetch data from API, returning None on failure or while rate limited."""
+    global rate_limited_until
+    # Fail fast inside a Retry-After window instead of queueing on the limiter
+    if rate_limited():
+        return None
+    try:
+        async with api_limiter, api_semaphore:
+            if rate_limited():
+                return None
+            async with session.get(f"{COINGECKO_API_URL}/{endpoint}", params=params, timeout=REQUEST_TIMEOUT) as response:
+                if response.status == 429:
+                    delay = retry_after(response.headers)
+                    rate_limited_until = max(rate_limited_until, time.monotonic() + delay)
+                    logger.warning("API Error: rate limited, pausing requests for %ss", delay)
+                    return None
+                response.raise_for_status()
+                return orjson.loads(await response.read())
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+        logger.warning("API Error: %s", e)
+        return None
+
+async def api_request(session: aiohttp.ClientSession, endpoint: str, params: dict = None, use_cache: bool = True):
+    """Fetch data from API with caching. use_cache=False forces a refetch."""
+    # Sorted keys so equal params hit the same entry whatever their insertion order
+    cache_key = (endpoint, orjson.dumps(params or {}, option=orjson.OPT_SORT_KEYS))
+    if use_cache and cache_key in cache:
         return cache[cache_key]
+    # Concurrent callers for the same key share the request already in flight
+    if cache_key in inflight:
+        pending = inflight[cache_key]
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise  # we were cancelled ourselves
+            # The leading call was cancelled, not us: fetch on our own
+            return await api_request(session, endpoint, params, use_cache)
+    future = asyncio.get_running_loop().create_future()
+    inflight[cache_key] = future
     try:
-        response = requests.get(f"{COINGECKO_API_URL}/{endpoint}", params=params)
-        response.raise_for_status()
-        data = response.json()
-        cache[cache_key] = data
+        data = await fetch_json(session, endpoint, params)
+        # Remember failures briefly so every tap doesn't retry, but never mask a good entry.
+        # While rate limited the Retry-After deadline already gates calls, and ends on time.
+        if data is not None or (cache_key not in cache and not rate_limited()):
+            cache[cache_key] = data
+        future.set_result(data)
         return data
-    except requests.RequestException as e:
-        print(f"API Error: {e}")
-        return None
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved so an unawaited future doesn't warn
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        del inflight[cache_key]
+
+async def post_init(app: Application):
+    """Open the shared CoinGecko session once the event loop is running."""
+    app.bot_data["session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, limit_per_host=10, ttl_dns_cache=300, keepalive_timeout=60),
+        headers={"Accept": "application/json"},
+    )
+
+async def fetch_top_cryptos(session: aiohttp.ClientSession, use_cache: bool = True):
+    """Fetch the top cryptocurrencies with their button labels precomputed."""
+    top_cryptos = await api_request(session, "coins/markets", TOP_MARKETS_PARAMS, use_cache=use_cache)
+    for crypto in top_cryptos or ():
+        if "label" not in crypto:
+            crypto["label"] = f"{crypto['name']} ({crypto['symbol'].upper()})"
+    return top_cryptos
+
+async def refresh_markets(context: ContextTypes.DEFAULT_TYPE):
+    """Keep the top cryptocurrencies list warm in bot_data for the menu handlers."""
+    top_cryptos = await fetch_top_cryptos(context.bot_data["session"], use_cache=False)
+    if top_cryptos:
+        context.bot_data["top"] = top_cryptos
+
+async def post_shutdown(app: Application):
+    await app.bot_data["session"].close()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await show_main_menu(update)
+    await show_main_menu(update, context)
     
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "*Welcome to Crypto Price Bot!*\n"
-        "Commands:\n"
-        "/start - Main menu\n"
-        "/help - Help message\n"
-        "/favorites - Show favorite cryptos",
-        parse_mode="Markdown"
-    )
+    await update.message.reply_text(HELP_TEXT, parse_mode="Markdown")
 
-async def show_main_menu(update: Update):
-    keyboard = [
-        [InlineKeyboardButton("Top Cryptocurrencies", callback_data="top100")],
-        [InlineKeyboardButton("Favorites", callback_data="favorites")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "*Crypto Price Bot*\nChoose an option:",
-        reply_markup=reply_markup,
+        reply_markup=MAIN_MENU_MARKUP,
         parse_mode="Markdown"
     )
 
-async def show_top_cryptos(update: Update):
-    top_cryptos = api_request("coins/markets", {"vs_currency": "usd", "order": "market_cap_desc", "per_page": 10})
+async def show_top_cryptos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    top_cryptos = context.bot_data.get("top") or await fetch_top_cryptos(context.bot_data["session"])
     if not top_cryptos:
         await update.callback_query.edit_message_text("❌ Failed to fetch top cryptocurrencies.")
         return
-    keyboard = [[InlineKeyboardButton(f"{crypto['name']} ({crypto['symbol'].upper()})", callback_data=f"crypto:{crypto['id']}")] for crypto in top_cryptos]
+    keyboard = [[InlineKeyboardButton(crypto["label"], callback_data=f"crypto:{crypto['id']}")] for crypto in top_cryptos]
     await update.callback_query.edit_message_text(
         "*Top Cryptocurrencies:*",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode="Markdown"
     )
 
-async def show_favorites(update: Update):
-    user_id = update.callback_query.from_user.id
-    favorites = user_favorites.get(user_id, [])
+async def show_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    favorites = context.user_data.get("favorites", set())
     if not favorites:
         await update.callback_query.edit_message_text("No favorite cryptocurrencies yet.")
         return
-    keyboard = [[InlineKeyboardButton(fav.capitalize(), callback_data=f"crypto:{fav}")] for fav in favorites]
+    keyboard = [[InlineKeyboardButton(fav.capitalize(), callback_data=f"crypto:{fav}")] for fav in sorted(favorites)]
     await update.callback_query.edit_message_text(
         "Your Favorites:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+CALLBACK_HANDLERS: Final = {
+    "main_menu": show_main_menu,
+    "top100": show_top_cryptos,
+    "favorites": show_favorites,
+}
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route inline keyboard taps by exact callback data."""
+    handler = CALLBACK_HANDLERS.get(update.callback_query.data)
+    if handler:
+        await handler(update, context)
+
+def setup_logging() -> QueueListener:
+    """Send log records through a queue so handlers never block on stdout."""
+    log_queue = queue.SimpleQueue()
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.WARNING,
+        handlers=[QueueHandler(log_queue)],
+    )
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    log_listener = setup_logging()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .http_version("2")
+        # Stay under Telegram's 30 msg/s bot limit and retry RetryAfter once
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30, overall_time_period=1,
+            group_max_rate=20, group_time_period=60,
+            max_retries=1,
+        ))
+        # bot_data holds the live HTTP session and market snapshots, keep it out of the pickle
+        .persistence(PicklePersistence(filepath=PERSISTENCE_FILE, store_data=PersistenceInput(bot_data=False)))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CallbackQueryHandler(show_main_menu, pattern="main_menu"))
-    app.add_handler(CallbackQueryHandler(show_top_cryptos, pattern="top100"))
-    app.add_handler(CallbackQueryHandler(show_favorites, pattern="favorites"))
+    app.add_handler(CallbackQueryHandler(handle_callback))
+
+    # Jitter the schedule so several instances don't refresh in lockstep
+    app.job_queue.run_repeating(
+        refresh_markets,
+        interval=MARKETS_REFRESH_INTERVAL + random.uniform(-5, 5),
+        first=random.uniform(0, 5),
+    )
 
     app.run_polling()
+    log_listener.stop()
 
 if __name__ == "__main__":
     main()